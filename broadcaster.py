@@ -0,0 +1,158 @@
+import json
+import queue
+import threading
+import time
+
+# Server-sent events fan-out for newly completed analyses.
+# Every payload is encoded once and the same bytes are queued for every client,
+# so publishing never waits on a slow dashboard.
+
+KEEPALIVE_SECONDS = 15
+
+
+class _Client:
+    def __init__(self, max_queue: int):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.closed = False
+
+
+class Broadcaster:
+    """
+    Fans out published payloads to every connected server-sent events client.
+
+    Args:
+        max_queue (int): Number of pending messages kept per client. When a client
+            falls behind, its oldest pending message is dropped.
+        max_drops (int): Number of dropped messages after which a slow client is
+            disconnected. The dashboard reconnects and reloads from DynamoDB.
+    """
+
+    def __init__(self, max_queue: int = 100, max_drops: int = 1000):
+        self.max_queue = max_queue
+        self.max_drops = max_drops
+        self._clients = set()
+        self._lock = threading.Lock()
+        self.published = 0
+        self.dropped = 0
+        self.evicted = 0
+        self._lag_total = 0.0
+        self._lag_count = 0
+        self._lag_max = 0.0
+
+    def publish(self, payload: dict) -> int:
+        """
+        Queues a payload for all connected clients.
+
+        Args:
+            payload (dict): The message to send, e.g. {"opinionId": ..., "opinion": ...}.
+
+        Returns:
+            int: Number of clients the payload was queued for.
+        """
+        frame = f"data: {json.dumps(payload)}\n\n".encode()
+        item = (time.monotonic(), frame)
+
+        with self._lock:
+            clients = list(self._clients)
+            self.published += 1
+
+        for client in clients:
+            self._enqueue(client, item)
+        return len(clients)
+
+    def _enqueue(self, client: _Client, item) -> None:
+        while not client.closed:
+            try:
+                client.queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            try:
+                client.queue.get_nowait()
+            except queue.Empty:
+                continue
+            client.dropped += 1
+            with self._lock:
+                self.dropped += 1
+            if client.dropped >= self.max_drops:
+                self._evict(client)
+                return
+
+    def _evict(self, client: _Client) -> None:
+        with self._lock:
+            if client not in self._clients:
+                return
+            self._clients.discard(client)
+            client.closed = True
+            self.evicted += 1
+        print(f"Disconnecting slow client after {client.dropped} dropped messages")
+        # Make room for the sentinel so the stream loop wakes up and exits
+        while True:
+            try:
+                client.queue.put_nowait(None)
+                return
+            except queue.Full:
+                try:
+                    client.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _record_lag(self, published_at: float) -> None:
+        lag = time.monotonic() - published_at
+        with self._lock:
+            self._lag_total += lag
+            self._lag_count += 1
+            self._lag_max = max(self._lag_max, lag)
+
+    def stream(self):
+        """
+        Yields server-sent events frames for one client until it disconnects.
+
+        Yields:
+            bytes: Encoded event frames and keepalive comments.
+        """
+        client = _Client(self.max_queue)
+        with self._lock:
+            self._clients.add(client)
+        print(f"Client connected, total clients: {len(self._clients)}")
+
+        try:
+            yield b": connected\n\n"
+            while True:
+                try:
+                    item = client.queue.get(timeout=KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    # The eviction sentinel can be taken by a concurrent publisher, so check the flag too
+                    if client.closed:
+                        break
+                    yield b": keepalive\n\n"
+                    continue
+                if item is None:
+                    break
+                published_at, frame = item
+                yield frame
+                self._record_lag(published_at)
+        finally:
+            with self._lock:
+                self._clients.discard(client)
+            print(f"Client disconnected, total clients: {len(self._clients)}")
+
+    def stats(self) -> dict:
+        """
+        Returns connection counts and send lag for monitoring.
+
+        Returns:
+            dict: Clients, published/dropped/evicted counters and send lag in seconds.
+        """
+        with self._lock:
+            clients = list(self._clients)
+            return {
+                'clients': len(clients),
+                'pending': sum(client.queue.qsize() for client in clients),
+                'published': self.published,
+                'dropped': self.dropped,
+                'evicted': self.evicted,
+                'send_lag_avg': self._lag_total / self._lag_count if self._lag_count else 0.0,
+                'send_lag_max': self._lag_max,
+            }
@@ -1,8 +1,11 @@
 from dotenv import load_dotenv
-from litellm import completion
+from llm import call_llm, new_deadline
+from scheduler import PRIORITY_INTERACTIVE
 import os
 import json
+import re
 import requests
+from bisect import bisect_right
 
 load_dotenv()
 
@@ -10,7 +13,7 @@ load_dotenv()
 #os.environ["OPENAI_API_KEY"] = "your-openai-key"
 #os.environ["OPENROUTER_API_KEY"] = 
 
-def get_llm_analysis(str):
+def get_llm_analysis(str, deadline=None, priority=PRIORITY_INTERACTIVE):
     print("🔄 Getting LLM analysis...")
     messages = [{ "content": str,"role": "user"}, { "content": '''
 You are a smart assistant designed to extract messages from a specific Telegram chat.
@@ -23,8 +26,10 @@ Your analysis should return ONLY structured output with a summary of the strateg
  ''',"role": "system"}]
 
     # openai call
-    response = completion(
+    response = call_llm(
         model="openrouter/openai/gpt-4o",
+        deadline=deadline,
+        priority=priority,
         response_format={
             "type": "json_schema",
             "json_schema": {
@@ -50,7 +55,6 @@ Your analysis should return ONLY structured output with a summary of the strateg
         messages=messages)
     #print(response)
     #print(response.choices[0].message.content)
-    #response = completion(model="openrouter/deepseek/deepseek-chat", messages=messages)
     return json.loads(response.choices[0].message.content)
 
 def get_defi_llama_data():
@@ -61,107 +65,192 @@ def get_defi_llama_data():
         return response.json()
     return None
 
+# Match ranks, lower is better: exact name or symbol, then the contract as a whole word of the name
+EXACT_MATCH = 0
+WORD_MATCH = 1
+
 def find_related_protocols(llm_data, defi_llama_data):
-    smart_contracts = llm_data.get('SmartContracts', [])
-    related_protocols = []
-    
-    for protocol in defi_llama_data:
-        protocol_name = protocol.get('name', '').upper()
-        for contract in smart_contracts:
-            if contract.upper() in protocol_name:
-                related_protocols.append(protocol)
-                break
-    
-    tokens_tokens = llm_data.get('Tokens', [])
-    
+    """
+    Find DeFi Llama protocols for the smart contracts and tokens of a strategy.
+
+    Substring matches are not used, they let e.g. ETH or USD pull in unrelated protocols.
+    Exact matches come first, then whole-word name matches, each ordered by TVL, and a
+    protocol matching several ways is listed once.
+    """
+    smart_contracts = [contract.upper() for contract in llm_data.get('SmartContracts', []) if contract]
+    token_symbols = {token.upper() for token in llm_data.get('Tokens', []) if token}
+    word_patterns = [re.compile(rf'(?<![A-Z0-9]){re.escape(contract)}(?![A-Z0-9])') for contract in smart_contracts]
+
+    ranks = {}
+    protocols = {}
     for protocol in defi_llama_data:
-        token_name = protocol.get('symbol', '').upper()
-        for token in tokens_tokens:
-            if token.upper() in token_name:
-                related_protocols.append(protocol)
-                break
-    return related_protocols
+        protocol_name = (protocol.get('name') or '').upper()
+        token_name = (protocol.get('symbol') or '').upper()
+        if protocol_name in smart_contracts or token_name in token_symbols:
+            rank = EXACT_MATCH
+        elif any(pattern.search(protocol_name) for pattern in word_patterns):
+            rank = WORD_MATCH
+        else:
+            continue
+        key = protocol.get('id') or protocol.get('name')
+        if key not in ranks or rank < ranks[key]:
+            ranks[key] = rank
+            protocols[key] = protocol
 
-def format_tvl(tvl):
+    return sorted(protocols.values(), key=lambda protocol: (
+        ranks[protocol.get('id') or protocol.get('name')],
+        -(parse_tvl(protocol.get('tvl')) or 0),
+    ))
+
+# TVL grades as (lower bound in USD, grade, description), sorted by lower bound
+TVL_TIERS = [
+    (0, "Low Liquidity / Experimental", "High risk"),
+    (100_000_000, "Niche Protocols", "Early-stage"),
+    (500_000_000, "Emerging Players", "Growing adoption, but limited market influence"),
+    (1_000_000_000, "Mid-Level Protocols", ""),
+    (5_000_000_000, "Top Tier", ""),
+    (10_000_000_000, "Elite Protocols", "Market leaders"),
+]
+TVL_TIER_BOUNDS = [bound for bound, _, _ in TVL_TIERS]
+
+REPORT_TEMPLATE = '''1. Strategy tokens, protocols, overview
+{overview}
+
+2. Strategy steps
+{steps}
+
+3. Expected rewards and timeframe
+{rewards}
+
+4. Protocols' security
+{security}
+
+5. Key risks, required actions/monitoring
+{risks}'''
+
+PROTOCOL_SECURITY_TEMPLATE = '''{name} ({symbol})
+TVL: {tvl} - {grade}
+Audits: {audits}
+Audit links: {audit_links}
+Twitter: {twitter}'''
+
+def parse_tvl(tvl):
     try:
-        if tvl is None:
-            return "N/A"
-        return f"${float(tvl):,.2f}"
+        return float(tvl) if tvl is not None else None
     except (ValueError, TypeError):
+        return None
+
+def format_tvl(tvl):
+    tvl = parse_tvl(tvl)
+    if tvl is None:
         return "N/A"
+    return f"${tvl:,.2f}"
+
+def grade_tvl(tvls):
+    """Grade raw TVL values against TVL_TIERS in one pass, None for missing values."""
+    values = [parse_tvl(tvl) for tvl in tvls]
+    indexes = [bisect_right(TVL_TIER_BOUNDS, value) - 1 if value is not None else None for value in values]
+    return [TVL_TIERS[max(index, 0)] if index is not None else None for index in indexes]
 
-def analyze_protocols(smart_contracts, tokens, related_protocols):
+def analyze_protocols(related_protocols):
+    tiers = grade_tvl([protocol.get('tvl') for protocol in related_protocols])
     protocol_info = []
-    for protocol in related_protocols:
+    for protocol, tier in zip(related_protocols, tiers):
+        if tier is None:
+            grade = "Not graded"
+        else:
+            _, grade, description = tier
+            grade = f"{grade} ({description})" if description else grade
         info = {
             'name': protocol.get('name', 'Unknown'),
             'symbol': protocol.get('symbol', 'Unknown'),
             'tvl': format_tvl(protocol.get('tvl')),
+            'grade': grade,
             'audits': protocol.get('audits', 'No audit information'),
             'audit_links': protocol.get('audit_links', []),
             'twitter': f"https://twitter.com/{protocol.get('twitter')}" if protocol.get('twitter') else "No Twitter handle"
         }
         protocol_info.append(info)
-    
-    # Create prompt for LLM
-    messages = [{"content": f'''
-Analyze the following protocols and select the best suited details for each smart contract in the list.
-Smart Contracts: {smart_contracts}
-Tokens: {tokens}
-Protocol Details: {json.dumps(protocol_info, indent=2)}
-
-Please provide a user-friendly summary including:
-- TVL (Total Value Locked)
-- Number of audits
-- Audit links
-- Twitter links
-For each smart contract. In output don't use markdown
-    ''', "role": "user"}, { "content": '''                 
-In output don't use markdown
- ''' ,"role": "system"}]
-
-    response = completion(model="openrouter/openai/gpt-4o", messages=messages)
-    return response.choices[0].message.content
-
-def combine_analysis(llm_data, protocol_analysis):
+    return protocol_info
+
+def render_security_section(protocol_info):
+    return "\n\n".join(
+        PROTOCOL_SECURITY_TEMPLATE.format(
+            name=info['name'],
+            symbol=info['symbol'],
+            tvl=info['tvl'],
+            grade=info['grade'],
+            audits=info['audits'],
+            audit_links=", ".join(info['audit_links']) if info['audit_links'] else "No audit links",
+            twitter=info['twitter'],
+        )
+        for info in protocol_info
+    )
+
+def combine_analysis(llm_data, protocol_info, deadline=None, priority=PRIORITY_INTERACTIVE):
+    # The security section is rendered from protocol_info, the LLM only writes the narrative
+    protocols = [f"{info['name']} ({info['symbol']}): {info['grade']}" for info in protocol_info]
     messages = [{"content": f'''
 
-Combine the following DeFi strategy information into a user-friendly summary:
+Write a user-friendly summary of the following DeFi strategy:
 
 Strategy Analysis:
 {json.dumps(llm_data, indent=2)}
 
-Protocol Analysis:
-{protocol_analysis}
-
-Please provide a comprehensive but easy-to-understand summary that combines both the strategy details
-and the protocols' information. In output don't use markdown, but use the following blocks:
-1. **Strategy tokens, protocols, overview**.
-2. **Strategy steps**
-3. **Expected rewards and timeframe**
-4. **Protocols' security (TVL (set protocol grade base on the following TVL ranges:
-$10B+		    Elite Protocols	Market leaders
-$5B – $10B		Top Tier	
-$1B – $5B		Mid-Level Protocols	
-$500M – $1B		Emerging Players	Growing adoption, but limited market influence
-$100M – $500M	Niche Protocols	Early-stage
-Below $100M		Low Liquidity / Experimenta High risk
-), audits links) and full links to twitter**
-5. **Key risks, required actions/monitoring**
+Related protocols and their TVL grades:
+{json.dumps(protocols, indent=2)}
+
+Please provide comprehensive but easy-to-understand texts for the following blocks. Don't use markdown:
+- Overview: strategy tokens, protocols, overview
+- Steps: strategy steps
+- Rewards: expected rewards and timeframe
+- Risks: key risks, required actions/monitoring
     ''', "role": "user"}]
 
-    response = completion(model="openrouter/openai/gpt-4o", messages=messages)
-    return response.choices[0].message.content
+    response = call_llm(
+        model="openrouter/openai/gpt-4o",
+        deadline=deadline,
+        priority=priority,
+        response_format={
+            "type": "json_schema",
+            "json_schema": {
+                "name": "strategy_summary_response",
+                "strict": True,
+                "schema": {
+                    "type": "object",
+                    "additionalProperties": False,
+                    "properties": {
+                        "Overview": {"type": "string", "description": "Strategy tokens, protocols, overview"},
+                        "Steps": {"type": "array", "items": {"type": "string"}, "description": "Array of strategy steps"},
+                        "Rewards": {"type": "string", "description": "Expected rewards and timeframe"},
+                        "Risks": {"type": "string", "description": "Key risks, required actions/monitoring"}
+                    },
+                    "required": ["Overview", "Steps", "Rewards", "Risks"]
+                }
+            }
+        },
+        messages=messages)
+    narrative = json.loads(response.choices[0].message.content)
+
+    return REPORT_TEMPLATE.format(
+        overview=narrative.get('Overview', 'N/A'),
+        steps="\n".join(f"{i}. {step}" for i, step in enumerate(narrative.get('Steps') or [], 1)) or 'N/A',
+        rewards=narrative.get('Rewards', 'N/A'),
+        security=render_security_section(protocol_info),
+        risks=narrative.get('Risks', 'N/A'),
+    )
 
 def convert_markdown_links(text):
     """Convert any markdown-style links to direct URLs."""
-    import re
     pattern = r'\[([^\]]+)\]\(([^\)]+)\)'
     return re.sub(pattern, r'\2', text)
 
-def process_invest_idea(investIdeaStr):
+def process_invest_idea(investIdeaStr, priority=PRIORITY_INTERACTIVE):
+    # All LLM calls below share one deadline
+    deadline = new_deadline()
+
     # Step 1: Get LLM analysis
-    llm_data = get_llm_analysis(investIdeaStr)
+    llm_data = get_llm_analysis(investIdeaStr, deadline, priority)
     print("Step 1 - LLM Analysis:", json.dumps(llm_data, indent=2))
 
     # Step 2: Get DeFi Llama data
@@ -174,18 +263,18 @@ def process_invest_idea(investIdeaStr):
     related_protocols = find_related_protocols(llm_data, defi_llama_data)
     print("\nStep 3 - Related Protocols:", json.dumps([p.get('name', 'Unknown') for p in related_protocols], indent=2))
 
-    # Step 4: Analyze protocols
-    final_analysis = None
+    # Step 4: Grade protocols
+    protocol_info = None
     if related_protocols:
-        final_analysis = analyze_protocols(llm_data['SmartContracts'], llm_data['Tokens'], related_protocols[:10])
-        print("\nStep 4 - Final Analysis:", final_analysis)
+        protocol_info = analyze_protocols(related_protocols[:10])
+        print("\nStep 4 - Protocol Details:", json.dumps(protocol_info, indent=2))
     else:
         print("No related protocols found")
         return
 
     # Step 5: Combine information into user-friendly format
-    if final_analysis:
-        user_friendly_summary = combine_analysis(llm_data, final_analysis)
+    if protocol_info:
+        user_friendly_summary = combine_analysis(llm_data, protocol_info, deadline, priority)
         print("\nStep 5 - User-Friendly Summary:", user_friendly_summary)
         
         # Step 6: Convert markdown Twitter links to direct URLs
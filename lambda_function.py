@@ -5,8 +5,9 @@ import requests
 import time
 import json
 
-from tools import ask_model
+from tools import SUMMARY_INSTRUCTIONS, ask_model_map_reduce
 from defillama import process_invest_idea
+from scheduler import PRIORITY_BROADCAST, PRIORITY_INTERACTIVE
 
 load_dotenv()
 # Telegram configuration
@@ -186,8 +187,7 @@ def summarize_messages(parameters: list) -> str:
         str: A summary of the chat and extracted action points.
     """
     messages = next(item["value"] for item in parameters if item["name"] == "messages")
-    instructions = "Given the messages extracted from the chat, summarize.\n"
-    return ask_model(messages, instructions)
+    return ask_model_map_reduce(messages, SUMMARY_INSTRUCTIONS)
 
 def translate_messages(parameters: list) -> str:
     """
@@ -260,7 +260,9 @@ def add_opinion(user_id: str, opinion: str):
 
     try:
         print(f"Adding opinion for user {user_id}: {opinion}")
-        data = process_invest_idea(opinion)
+        # Ideas from the monitored channel are broadcast in the background, users wait for their own
+        priority = PRIORITY_BROADCAST if user_id == 'system' else PRIORITY_INTERACTIVE
+        data = process_invest_idea(opinion, priority)
         print(f"Processed data: {data}")
 
         # First, get the existing item
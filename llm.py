@@ -0,0 +1,288 @@
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+import litellm
+from dotenv import load_dotenv
+from litellm import completion
+
+from scheduler import PRIORITY_INTERACTIVE, QueueTimeout, scheduler
+
+load_dotenv()
+
+# Shared wrapper for all litellm completion calls: per-call and per-pipeline deadlines,
+# retries with jittered backoff, hedged requests, a fallback model and a circuit breaker.
+# Every provider request, including retries and hedges, is admitted by the shared scheduler.
+
+CALL_TIMEOUT = float(os.getenv('LLM_CALL_TIMEOUT', 60))
+PIPELINE_TIMEOUT = float(os.getenv('LLM_PIPELINE_TIMEOUT', 180))
+MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 2))
+BACKOFF_BASE = 1.0
+FALLBACK_MODEL = os.getenv('LLM_FALLBACK_MODEL', 'openrouter/deepseek/deepseek-chat')
+
+# A duplicate request is sent once a call takes longer than the p95 of recent latencies
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30.0
+
+# Completion size assumed for the token budget when max_tokens is not set
+DEFAULT_COMPLETION_TOKENS = 1000
+
+TRANSIENT_ERRORS = (
+    litellm.Timeout,
+    litellm.RateLimitError,
+    litellm.APIConnectionError,
+    litellm.ServiceUnavailableError,
+    litellm.InternalServerError,
+)
+
+
+def _start(fn, *args) -> Future:
+    """Runs fn on its own thread, so a hedge leg never waits for a free pool worker."""
+    future = Future()
+
+    def run():
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the pipeline deadline passes before the LLM answered."""
+
+
+class CircuitOpen(Exception):
+    """Raised when every candidate model is skipped by its circuit breaker."""
+
+
+class _ModelHealth:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._failures = 0
+        self._opened_at = None
+        self._trial_started = None
+
+    def record_latency(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+
+    def p95(self):
+        with self._lock:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[int(len(latencies) * 0.95) - 1]
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_started = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._failures >= BREAKER_THRESHOLD:
+                self._opened_at = time.monotonic()
+                self._trial_started = None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at < BREAKER_COOLDOWN:
+                return False
+            # Half-open: let one trial request through and keep the others out until it
+            # succeeds or fails. A trial that never reports back is given up after CALL_TIMEOUT.
+            if self._trial_started is not None and now - self._trial_started < CALL_TIMEOUT:
+                return False
+            self._trial_started = now
+            return True
+
+
+_health = {}
+_health_lock = threading.Lock()
+
+
+def _get_health(model: str) -> _ModelHealth:
+    with _health_lock:
+        return _health.setdefault(model, _ModelHealth())
+
+
+def new_deadline(timeout: float = PIPELINE_TIMEOUT) -> float:
+    """
+    Creates a deadline shared by all LLM calls of one pipeline run.
+
+    Args:
+        timeout (float): Seconds the whole pipeline may spend waiting on the LLM.
+
+    Returns:
+        float: Deadline as a time.monotonic() timestamp.
+    """
+    return time.monotonic() + timeout
+
+
+def _call_timeout(deadline) -> float:
+    if deadline is None:
+        return CALL_TIMEOUT
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("LLM pipeline deadline exceeded")
+    return min(CALL_TIMEOUT, remaining)
+
+
+def _estimate_tokens(messages: list, kwargs: dict) -> int:
+    # Roughly 4 characters per token
+    prompt_tokens = sum(len(str(message.get('content', ''))) for message in messages) // 4
+    return prompt_tokens + kwargs.get('max_tokens', DEFAULT_COMPLETION_TOKENS)
+
+
+def _admit(messages: list, timeout: float, priority: str, kwargs: dict):
+    """Waits for the scheduler and returns the admission (estimated tokens, budget window) and the timeout left."""
+    tokens = _estimate_tokens(messages, kwargs)
+    queued = time.monotonic()
+    window = scheduler.acquire(priority, tokens, timeout)
+    return (tokens, window), max(timeout - (time.monotonic() - queued), 1.0)
+
+
+def _send(model: str, messages: list, timeout: float, admission: tuple, kwargs: dict):
+    started = time.monotonic()
+    response = completion(model=model, messages=messages, timeout=timeout, **kwargs)
+    _get_health(model).record_latency(time.monotonic() - started)
+
+    usage = getattr(response, 'usage', None)
+    if usage and getattr(usage, 'total_tokens', None):
+        tokens, window = admission
+        scheduler.record_usage(tokens, usage.total_tokens, window)
+    return response
+
+
+def _timed_call(model: str, messages: list, timeout: float, priority: str, kwargs: dict):
+    admission, timeout = _admit(messages, timeout, priority, kwargs)
+    return _send(model, messages, timeout, admission, kwargs)
+
+
+def _hedged_call(model: str, messages: list, deadline, priority: str, kwargs: dict):
+    timeout = _call_timeout(deadline)
+    hedge_after = _get_health(model).p95()
+    # Hedging while requests are queued would only add to the backlog
+    if hedge_after is None or hedge_after >= timeout or scheduler.has_backlog():
+        return _timed_call(model, messages, timeout, priority, kwargs)
+
+    # The hedge timer starts after admission, so time spent in our queue is not taken for provider latency
+    admission, timeout = _admit(messages, timeout, priority, kwargs)
+    first = _start(_send, model, messages, timeout, admission, kwargs)
+    if hedge_after >= timeout:
+        return first.result()
+    done, _ = wait([first], timeout=hedge_after)
+    if done:
+        return first.result()
+
+    print(f"⏱️ {model} slower than p95 ({hedge_after:.1f}s), sending hedged request")
+    second = _start(_timed_call, model, messages, timeout - hedge_after, priority, kwargs)
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            # Prefer the provider's error over the hedge not being admitted
+            if error is None or isinstance(error, QueueTimeout):
+                error = future.exception()
+    raise error
+
+
+def _call_with_retries(model: str, messages: list, deadline, priority: str, kwargs: dict):
+    health = _get_health(model)
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = _hedged_call(model, messages, deadline, priority, kwargs)
+            health.record_success()
+            return response
+        except TRANSIENT_ERRORS as e:
+            health.record_failure()
+            if attempt == MAX_RETRIES or not health.allow():
+                raise
+            delay = random.uniform(0, BACKOFF_BASE * 2 ** attempt)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise
+            print(f"Transient error from {model}: {str(e)}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def _supports_response_schema(model: str) -> bool:
+    try:
+        return litellm.supports_response_schema(model=model)
+    except Exception:
+        # Models missing from litellm's model map are treated as unsupported
+        return False
+
+
+def _adapt_request(model: str, messages: list, kwargs: dict):
+    """Replaces a json_schema response_format by JSON mode and schema instructions if the fallback lacks schema support."""
+    response_format = kwargs.get('response_format')
+    if not response_format or response_format.get('type') != 'json_schema' or _supports_response_schema(model):
+        return messages, kwargs
+
+    schema = response_format['json_schema']['schema']
+    instructions = (
+        "Respond ONLY with a JSON object that matches the following JSON schema, "
+        f"without any other text:\n{json.dumps(schema)}"
+    )
+    print(f"{model} does not support response schemas, falling back to JSON mode")
+    adapted = dict(kwargs, response_format={"type": "json_object"})
+    return messages + [{"content": instructions, "role": "system"}], adapted
+
+
+def call_llm(model: str, messages: list, deadline: float = None, fallback_model: str = FALLBACK_MODEL,
+             priority: str = PRIORITY_INTERACTIVE, **kwargs):
+    """
+    Calls litellm completion with deadlines, retries, hedging and fallback.
+
+    Args:
+        model (str): The primary model, e.g. "openrouter/openai/gpt-4o".
+        messages (list): Chat messages passed to completion.
+        deadline (float): Optional pipeline deadline from new_deadline().
+        fallback_model (str): Model used when the primary one fails or its circuit is open.
+        priority (str): Scheduler priority class, see scheduler.PRIORITY_*.
+        **kwargs: Additional completion arguments such as response_format.
+
+    Returns:
+        The litellm completion response.
+    """
+    models = [model] + ([fallback_model] if fallback_model and fallback_model != model else [])
+    error = None
+    for candidate in models:
+        if not _get_health(candidate).allow():
+            print(f"Circuit open for {candidate}, skipping")
+            continue
+        try:
+            # The primary request is sent exactly as the caller built it
+            if candidate == model:
+                candidate_messages, candidate_kwargs = messages, kwargs
+            else:
+                candidate_messages, candidate_kwargs = _adapt_request(candidate, messages, kwargs)
+            return _call_with_retries(candidate, candidate_messages, deadline, priority, candidate_kwargs)
+        except (DeadlineExceeded, QueueTimeout):
+            # Retrying or failing over would only queue again behind the same budget
+            raise
+        except Exception as e:
+            print(f"Error calling {candidate}: {str(e)}")
+            error = e
+    if error is not None:
+        raise error
+    raise CircuitOpen(f"No healthy model available among {models}")
@@ -0,0 +1,353 @@
+import heapq
+import itertools
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import boto3
+from botocore.exceptions import ClientError
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Admission control for LLM provider requests. The requests-per-minute and tokens-per-minute
+# budgets are counted in DynamoDB, so the Flask server, every Lambda invocation and batch jobs
+# share one budget. Within a process, waiting requests are ordered by weighted fair queuing.
+
+PRIORITY_INTERACTIVE = 'interactive'  # Dashboard /analyze and user ideas sent to the bot
+PRIORITY_BROADCAST = 'broadcast'  # Ideas from the monitored channel that are broadcast to all users
+PRIORITY_BACKFILL = 'backfill'  # Batch reprocessing
+
+PRIORITY_WEIGHTS = {
+    PRIORITY_INTERACTIVE: 8,
+    PRIORITY_BROADCAST: 2,
+    PRIORITY_BACKFILL: 1,
+}
+
+# Share of the budget each class may use, so lower classes leave headroom for interactive
+# requests coming from other processes
+PRIORITY_BUDGET_SHARE = {
+    PRIORITY_INTERACTIVE: 1.0,
+    PRIORITY_BROADCAST: 0.8,
+    PRIORITY_BACKFILL: 0.5,
+}
+
+RPM_LIMIT = int(os.getenv('LLM_RPM_LIMIT', 60))
+TPM_LIMIT = int(os.getenv('LLM_TPM_LIMIT', 100000))
+BUDGET_TABLE = os.getenv('LLM_BUDGET_TABLE', 'llm_rate_limits')
+
+WINDOW_SECONDS = 60.0
+
+
+class QueueTimeout(Exception):
+    """Raised when a request could not be admitted before its timeout."""
+
+
+class LocalBudget:
+    """Sliding one-minute window kept in this process."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = deque()
+        self._tokens = deque()
+        self._token_sum = 0
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float) -> None:
+        while self._requests and now - self._requests[0] >= WINDOW_SECONDS:
+            self._requests.popleft()
+        while self._tokens and now - self._tokens[0][0] >= WINDOW_SECONDS:
+            self._token_sum -= self._tokens.popleft()[1]
+
+    def try_take(self, tokens: int, share: float):
+        """Takes budget for one request, returns (seconds to wait, window) with 0 when taken."""
+        with self._lock:
+            now = time.monotonic()
+            self._prune(now)
+            wait_for = 0.0
+            if len(self._requests) >= max(math.floor(self.rpm * share), 1):
+                wait_for = self._requests[0] + WINDOW_SECONDS - now
+            # A single request larger than the whole budget is admitted once the window is empty
+            if self._tokens and self._token_sum + tokens > self.tpm * share:
+                wait_for = max(wait_for, self._tokens[0][0] + WINDOW_SECONDS - now)
+            if wait_for > 0:
+                return wait_for, None
+            self._requests.append(now)
+            self._tokens.append((now, tokens))
+            self._token_sum += tokens
+            return 0.0, None
+
+    def adjust(self, window, delta: int) -> None:
+        with self._lock:
+            self._tokens.append((time.monotonic(), delta))
+            self._token_sum += delta
+
+    def usage(self) -> dict:
+        with self._lock:
+            self._prune(time.monotonic())
+            return {'requests': len(self._requests), 'tokens': self._token_sum}
+
+
+class DynamoDBBudget:
+    """
+    Fixed one-minute windows counted with conditional updates in DynamoDB.
+
+    The table has a string partition key "window" and TTL enabled on "expires_at".
+    If DynamoDB is unreachable, the process falls back to a LocalBudget.
+    """
+
+    def __init__(self, rpm: int, tpm: int, table: str = BUDGET_TABLE):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.table = table
+        self._local = LocalBudget(rpm, tpm)
+        self._dynamodb = None
+        self._last_usage = {'requests': 0, 'tokens': 0}
+
+    def _client(self):
+        if self._dynamodb is None:
+            self._dynamodb = boto3.client('dynamodb',
+                                          aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+                                          aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+                                          region_name='eu-central-1')
+        return self._dynamodb
+
+    def try_take(self, tokens: int, share: float):
+        """Takes budget for one request, returns (seconds to wait, window) with 0 when taken."""
+        now = time.time()
+        window = int(now // WINDOW_SECONDS)
+        # Jitter keeps waiting processes from retrying at the same instant
+        window_left = (window + 1) * WINDOW_SECONDS - now + random.uniform(0, 0.5)
+        max_requests = max(math.floor(self.rpm * share), 1)
+        try:
+            response = self._client().update_item(
+                TableName=self.table,
+                Key={'window': {'S': str(window)}},
+                UpdateExpression='ADD requests :one, tokens :tokens SET expires_at = :expires_at',
+                # A single request larger than the whole budget is admitted into an empty window
+                ConditionExpression='attribute_not_exists(requests) OR '
+                                    '(requests < :max_requests AND tokens <= :max_tokens)',
+                ExpressionAttributeValues={
+                    ':one': {'N': '1'},
+                    ':tokens': {'N': str(tokens)},
+                    ':expires_at': {'N': str(int(now + 10 * WINDOW_SECONDS))},
+                    ':max_requests': {'N': str(max_requests)},
+                    ':max_tokens': {'N': str(max(int(self.tpm * share) - tokens, 0))},
+                },
+                ReturnValues='UPDATED_NEW',
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return window_left, None
+            print(f"Error updating LLM budget in DynamoDB, using the local budget: {str(e)}")
+            return self._local.try_take(tokens, share)
+        except Exception as e:
+            print(f"Error updating LLM budget in DynamoDB, using the local budget: {str(e)}")
+            return self._local.try_take(tokens, share)
+
+        attributes = response.get('Attributes', {})
+        self._last_usage = {
+            'requests': int(attributes.get('requests', {}).get('N', 0)),
+            'tokens': int(attributes.get('tokens', {}).get('N', 0)),
+        }
+        return 0.0, window
+
+    def adjust(self, window, delta: int) -> None:
+        if window is None:
+            self._local.adjust(window, delta)
+            return
+        try:
+            self._client().update_item(
+                TableName=self.table,
+                Key={'window': {'S': str(window)}},
+                UpdateExpression='ADD tokens :delta',
+                ExpressionAttributeValues={':delta': {'N': str(delta)}},
+            )
+        except Exception as e:
+            print(f"Error correcting LLM token usage in DynamoDB: {str(e)}")
+
+    def usage(self) -> dict:
+        # Last values seen by this process, the table is not read just for stats
+        return dict(self._last_usage)
+
+
+class _Ticket:
+    def __init__(self, priority: str, tokens: int):
+        self.priority = priority
+        self.tokens = tokens
+        # Set once the ticket left the queue, admitted or timed out
+        self.cancelled = False
+        # (seconds to wait, window) from the last budget request
+        self.result = None
+        self.retry_at = 0.0
+
+
+class Scheduler:
+    """
+    Admits LLM requests within rate budgets in weighted fair order.
+
+    Every request gets a virtual finish tag of start + tokens / weight, where start is
+    the later of the scheduler's virtual time and the previous tag of its class. The
+    request with the smallest tag takes budget first, so interactive requests overtake
+    queued backfill work without starving it. Across processes, lower classes may only
+    use their PRIORITY_BUDGET_SHARE of the shared budget.
+
+    Args:
+        budget: Budget backend, DynamoDBBudget or LocalBudget.
+        weights (dict): Weight per priority class.
+        shares (dict): Share of the budget per priority class.
+    """
+
+    def __init__(self, budget=None, weights: dict = None, shares: dict = None):
+        self.budget = budget or DynamoDBBudget(RPM_LIMIT, TPM_LIMIT)
+        self.weights = dict(weights or PRIORITY_WEIGHTS)
+        self.shares = dict(shares or PRIORITY_BUDGET_SHARE)
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._last_tag = {priority: 0.0 for priority in self.weights}
+        # Only one budget request is in flight at a time, and never under self._cond
+        self._in_flight = False
+        self._metrics = {priority: {'admitted': 0, 'timed_out': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+                         for priority in self.weights}
+
+    def _head(self):
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+        return self._heap[0][2] if self._heap else None
+
+    def _take_budget(self, ticket: _Ticket) -> None:
+        """Asks the budget backend for the head ticket, runs on its own thread."""
+        try:
+            result = self.budget.try_take(ticket.tokens, self.shares[ticket.priority])
+        except Exception as e:
+            print(f"Error taking LLM budget: {str(e)}")
+            result = (1.0, None)
+        with self._cond:
+            self._in_flight = False
+            refund = ticket.cancelled and result[0] <= 0
+            if not ticket.cancelled:
+                ticket.result = result
+            self._cond.notify_all()
+        if refund:
+            # The request timed out while its budget was being taken
+            self.budget.adjust(result[1], -ticket.tokens)
+
+    def acquire(self, priority: str, tokens: int, timeout: float = None):
+        """
+        Blocks until the request may be sent to the provider.
+
+        Args:
+            priority (str): One of the PRIORITY_* classes.
+            tokens (int): Estimated prompt and completion tokens of the request.
+            timeout (float): Maximum seconds to wait in the queue.
+
+        Returns:
+            The budget window the request was counted in, to be passed to record_usage.
+
+        Raises:
+            QueueTimeout: If the request was not admitted within timeout.
+        """
+        started = time.monotonic()
+        ticket = _Ticket(priority, tokens)
+        with self._cond:
+            tag = max(self._virtual_time, self._last_tag[priority]) + tokens / self.weights[priority]
+            self._last_tag[priority] = tag
+            heapq.heappush(self._heap, (tag, next(self._seq), ticket))
+
+            while True:
+                now = time.monotonic()
+                wait_for = None
+                if ticket.result is not None:
+                    budget_wait, window = ticket.result
+                    ticket.result = None
+                    if budget_wait <= 0:
+                        # A request with a smaller tag may have arrived meanwhile; the budget is taken, so admit anyway
+                        ticket.cancelled = True
+                        self._virtual_time = max(self._virtual_time, tag)
+                        break
+                    ticket.retry_at = now + budget_wait
+
+                if self._head() is ticket and not self._in_flight:
+                    if now >= ticket.retry_at:
+                        self._in_flight = True
+                        threading.Thread(target=self._take_budget, args=(ticket,), daemon=True).start()
+                    else:
+                        wait_for = ticket.retry_at - now
+
+                if timeout is not None:
+                    remaining = started + timeout - time.monotonic()
+                    if remaining <= 0:
+                        ticket.cancelled = True
+                        self._metrics[priority]['timed_out'] += 1
+                        self._cond.notify_all()
+                        raise QueueTimeout(f"{priority} LLM request not admitted within {timeout:.1f}s")
+                    wait_for = remaining if wait_for is None else min(wait_for, remaining)
+                self._cond.wait(wait_for)
+
+            waited = time.monotonic() - started
+            metrics = self._metrics[priority]
+            metrics['admitted'] += 1
+            metrics['wait_total'] += waited
+            metrics['wait_max'] = max(metrics['wait_max'], waited)
+            # Let the next request in line check the budget
+            self._cond.notify_all()
+            return window
+
+    def has_backlog(self) -> bool:
+        """Returns True if requests are waiting for admission."""
+        with self._cond:
+            return self._head() is not None
+
+    def record_usage(self, estimated: int, actual: int, window=None) -> None:
+        """
+        Corrects the token budget once the provider reported the real usage.
+
+        Args:
+            estimated (int): Tokens passed to acquire.
+            actual (int): Tokens reported in the response usage.
+            window: The budget window returned by acquire.
+        """
+        self.budget.adjust(window, actual - estimated)
+        with self._cond:
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """
+        Returns budget usage and queue-wait metrics per priority class.
+
+        Returns:
+            dict: Requests and tokens used in the current window, and per class the
+                number of queued, admitted and timed out requests with wait times in seconds.
+        """
+        usage = self.budget.usage()
+        with self._cond:
+            queued = {priority: 0 for priority in self.weights}
+            for _, _, ticket in self._heap:
+                if not ticket.cancelled:
+                    queued[ticket.priority] += 1
+            return {
+                'requests_last_minute': usage['requests'],
+                'tokens_last_minute': usage['tokens'],
+                'rpm_limit': self.budget.rpm,
+                'tpm_limit': self.budget.tpm,
+                'classes': {
+                    priority: {
+                        'queued': queued[priority],
+                        'admitted': metrics['admitted'],
+                        'timed_out': metrics['timed_out'],
+                        'wait_avg': metrics['wait_total'] / metrics['admitted'] if metrics['admitted'] else 0.0,
+                        'wait_max': metrics['wait_max'],
+                    }
+                    for priority, metrics in self._metrics.items()
+                },
+            }
+
+
+# Shared by every LLM call in this process; the budget itself is shared through DynamoDB
+scheduler = Scheduler()
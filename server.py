@@ -1,25 +1,142 @@
-from flask import Flask, request, jsonify
+import base64
+import json
+import os
+import re
+from functools import lru_cache
+from urllib.parse import urlparse
+
+import requests
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
+from broadcaster import Broadcaster
 from defillama import process_invest_idea
+from scheduler import scheduler
+from tools import SUMMARY_INSTRUCTIONS, ask_model_stream
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
+# Pushes newly completed analyses to dashboard clients
+broadcaster = Broadcaster()
+
+# Only notifications from this topic are forwarded to dashboard clients
+SNS_TOPIC_ARN = os.getenv('SNS_TOPIC_ARN', 'arn:aws:sns:eu-central-1:035586480742:defi-opinions-topic')
+SNS_HOST_PATTERN = re.compile(r'^sns\.[a-z0-9-]+\.amazonaws\.com$')
+
+# Fields covered by the SNS signature, in signing order
+SNS_SIGNED_FIELDS = {
+    'Notification': ['Message', 'MessageId', 'Subject', 'Timestamp', 'TopicArn', 'Type'],
+    'SubscriptionConfirmation': ['Message', 'MessageId', 'SubscribeURL', 'Timestamp', 'Token', 'TopicArn', 'Type'],
+}
+
+def is_sns_url(url: str) -> bool:
+    parsed = urlparse(url)
+    return parsed.scheme == 'https' and bool(SNS_HOST_PATTERN.match(parsed.hostname or ''))
+
+@lru_cache(maxsize=8)
+def get_sns_certificate(url: str):
+    response = requests.get(url, timeout=10)
+    response.raise_for_status()
+    return x509.load_pem_x509_certificate(response.content)
+
+def verify_sns_message(message: dict) -> bool:
+    """
+    Verifies that an SNS message was signed by AWS for our topic.
+
+    Args:
+        message (dict): The parsed SNS HTTP(S) message.
+
+    Returns:
+        bool: True if the topic, signing certificate and signature are valid.
+    """
+    fields = SNS_SIGNED_FIELDS.get(message.get('Type'))
+    if not fields or message.get('TopicArn') != SNS_TOPIC_ARN:
+        return False
+    if not is_sns_url(message.get('SigningCertURL', '')):
+        return False
+
+    string_to_sign = ''.join(f"{field}\n{message[field]}\n" for field in fields if field in message)
+    algorithm = hashes.SHA256() if message.get('SignatureVersion') == '2' else hashes.SHA1()
+    try:
+        certificate = get_sns_certificate(message['SigningCertURL'])
+        certificate.public_key().verify(
+            base64.b64decode(message['Signature']), string_to_sign.encode(), padding.PKCS1v15(), algorithm
+        )
+        return True
+    except (InvalidSignature, KeyError, ValueError, requests.RequestException) as e:
+        print(f"Invalid SNS signature: {str(e)}")
+        return False
+
 @app.route('/analyze', methods=['POST'])
 def analyze():
     try:
         data = request.json
         if not data or 'message' not in data:
             return jsonify({'error': 'Missing message field'}), 400
-        
+
         analysis = process_invest_idea(data['message'])
         if analysis is None:
             return jsonify({'error': 'Failed to process investment idea'}), 500
-            
+
         return jsonify({'analysis': analysis})
-        
+
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/summarize', methods=['POST'])
+def summarize():
+    """Streams the chat summary as plain text while Bedrock generates it."""
+    data = request.json
+    if not data or 'messages' not in data:
+        return jsonify({'error': 'Missing messages field'}), 400
+
+    return Response(ask_model_stream(data['messages'], SUMMARY_INSTRUCTIONS), mimetype='text/plain')
+
+@app.route('/events', methods=['GET'])
+def events():
+    """Server-sent events stream of newly completed analyses."""
+    headers = {
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # Disable proxy buffering so events are flushed immediately
+    }
+    return Response(broadcaster.stream(), mimetype='text/event-stream', headers=headers)
+
+@app.route('/events/stats', methods=['GET'])
+def events_stats():
+    return jsonify(broadcaster.stats())
+
+@app.route('/llm/stats', methods=['GET'])
+def llm_stats():
+    return jsonify(scheduler.stats())
+
+@app.route('/sns', methods=['POST'])
+def sns():
+    """Receives the defi-opinions-topic SNS notifications published by the Lambda and forwards them to clients."""
+    try:
+        message = json.loads(request.get_data())
+        if not verify_sns_message(message):
+            return jsonify({'error': 'Invalid SNS message'}), 403
+
+        if message.get('Type') == 'SubscriptionConfirmation':
+            if not is_sns_url(message['SubscribeURL']):
+                return jsonify({'error': 'Unexpected SubscribeURL'}), 400
+            response = requests.get(message['SubscribeURL'], timeout=10)
+            if not response.ok:
+                return jsonify({'error': f'Failed to confirm subscription: {response.status_code}'}), 500
+            print("Successfully confirmed SNS subscription")
+            return jsonify({'status': 'Subscription confirmed'})
+
+        if message.get('Type') == 'Notification':
+            broadcaster.publish(json.loads(message['Message']))
+
+        return jsonify({'status': 'Message processed'})
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    app.run(debug=True, port=5000, threaded=True)
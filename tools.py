@@ -1,12 +1,125 @@
 import json
 import os
 import boto3
-from typing import Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Union
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
+MODEL_ID = "amazon.titan-text-lite-v1"
+
+# Titan Text Lite has a 4K token context window; ~4 characters per token leaves
+# room for the instructions and the 1000 token completion.
+MAX_CHUNK_CHARS = int(os.getenv('SUMMARY_CHUNK_CHARS', 8000))
+MAX_WORKERS = int(os.getenv('SUMMARY_MAX_WORKERS', 4))
+
+SUMMARY_INSTRUCTIONS = "Given the messages extracted from the chat, summarize.\n"
+
+# Prepended to the caller's instructions when partial results are combined
+REDUCE_INSTRUCTIONS = "The text above contains partial results for consecutive parts of the chat. Combine them into one answer to the following request.\n"
+
+
+def _get_bedrock_runtime():
+    return boto3.client(
+        service_name='bedrock-runtime',
+        aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+        region_name='us-east-1'
+    )
+
+
+def _build_body(prompt: str) -> str:
+    prompt_config = {
+        "inputText": prompt,
+        "textGenerationConfig": {
+            "maxTokenCount": 1000,
+            "stopSequences": [],
+            "temperature": 1,
+            "topP": 1,
+        },
+    }
+    return json.dumps(prompt_config)
+
+
+def _invoke(bedrock_runtime, prompt: str) -> str:
+    response = bedrock_runtime.invoke_model(
+        body=_build_body(prompt), modelId=MODEL_ID, accept="application/json", contentType="application/json"
+    )
+    response_body = json.loads(response.get("body").read())
+    return response_body.get("results")[0].get("outputText")
+
+
+def _invoke_stream(bedrock_runtime, prompt: str) -> Iterator[str]:
+    response = bedrock_runtime.invoke_model_with_response_stream(
+        body=_build_body(prompt), modelId=MODEL_ID, accept="application/json", contentType="application/json"
+    )
+    for event in response.get("body"):
+        chunk = event.get("chunk")
+        if chunk:
+            text = json.loads(chunk.get("bytes").decode()).get("outputText")
+            if text:
+                yield text
+
+
+def split_messages(messages: Union[str, list], chunk_size: int = MAX_CHUNK_CHARS) -> List[str]:
+    """
+    Splits chat messages into chunks that fit into a single model prompt.
+
+    Lists are split between messages, strings between lines. A single message
+    or line longer than chunk_size is cut into chunk_size pieces.
+
+    Args:
+        messages (Union[str, list]): The chat messages to split.
+        chunk_size (int): Maximum number of characters per chunk.
+
+    Returns:
+        List[str]: The chunks, in the original order.
+    """
+    parts = [str(m) for m in messages] if isinstance(messages, list) else str(messages).splitlines()
+
+    chunks = []
+    current = ""
+    for part in parts:
+        while len(part) > chunk_size:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(part[:chunk_size])
+            part = part[chunk_size:]
+        if current and len(current) + len(part) + 1 > chunk_size:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{part}" if current else part
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _map_chunks(bedrock_runtime, chunks: List[str], instructions: str, max_workers: int) -> List[str]:
+    print(f"Summarizing {len(chunks)} chunks with {max_workers} workers")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda chunk: _invoke(bedrock_runtime, chunk + instructions), chunks))
+
+
+def _reduce_prompt(bedrock_runtime, messages, instructions: str, chunk_size: int, max_workers: int) -> str:
+    """Map-reduces messages until the remaining summaries fit into one prompt of at most chunk_size characters."""
+    reduce_instructions = REDUCE_INSTRUCTIONS + instructions
+    chunks = split_messages(messages, chunk_size)
+    prompt_instructions = instructions
+    while len(chunks) > 1:
+        summaries = _map_chunks(bedrock_runtime, chunks, prompt_instructions, max_workers)
+        prompt_instructions = reduce_instructions
+        reduced = split_messages(summaries, chunk_size)
+        if len(reduced) >= len(chunks):
+            # Summaries are not getting shorter: combine them pairwise, cut to chunk_size,
+            # so the number of chunks still halves every round
+            reduced = ["\n".join(summaries[i:i + 2])[:chunk_size] for i in range(0, len(summaries), 2)]
+        chunks = reduced
+    return (chunks[0] if chunks else "")[:chunk_size] + prompt_instructions
+
+
 def ask_model(messages: str, instructions: str) -> str:
     """
     Generates responses from a language model based on chat messages and instructions.
@@ -22,34 +135,55 @@ def ask_model(messages: str, instructions: str) -> str:
         return "No messages was found. Consider using other chat."
 
     prompt = str(messages) + instructions
+    return _invoke(_get_bedrock_runtime(), prompt)
 
-    prompt_config = {
-        "inputText": prompt,
-        "textGenerationConfig": {
-            "maxTokenCount": 1000,
-            "stopSequences": [],
-            "temperature": 1,
-            "topP": 1,
-        },
-    }
 
-    body = json.dumps(prompt_config)
+def ask_model_map_reduce(messages: Union[str, list], instructions: str,
+                         chunk_size: int = MAX_CHUNK_CHARS, max_workers: int = MAX_WORKERS) -> str:
+    """
+    Generates responses for chat messages that may not fit into a single prompt.
 
-    bedrock_runtime = boto3.client(
-        service_name='bedrock-runtime',
-        aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-                          aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-        region_name='us-east-1'
-    )
+    The messages are split into chunks which are summarized in parallel, then the
+    summaries are summarized again until a single prompt remains.
 
-    model_id = "amazon.titan-text-lite-v1"
-    accept = "application/json"
-    content_type = "application/json"
+    Args:
+        messages (Union[str, list]): The chat messages to be used as context.
+        instructions (str): Additional instructions or question to provide to the model.
+        chunk_size (int): Maximum number of characters per chunk.
+        max_workers (int): Number of chunks sent to the model concurrently.
 
-    response = bedrock_runtime.invoke_model(
-        body=body, modelId=model_id, accept=accept, contentType=content_type
-    )
-    response_body = json.loads(response.get("body").read())
+    Returns:
+        str: The generated response from the language model.
+    """
+    if not messages:
+        return "No messages was found. Consider using other chat."
+
+    bedrock_runtime = _get_bedrock_runtime()
+    prompt = _reduce_prompt(bedrock_runtime, messages, instructions, chunk_size, max_workers)
+    return _invoke(bedrock_runtime, prompt)
+
+
+def ask_model_stream(messages: Union[str, list], instructions: str,
+                     chunk_size: int = MAX_CHUNK_CHARS, max_workers: int = MAX_WORKERS) -> Iterator[str]:
+    """
+    Streaming variant of ask_model_map_reduce.
+
+    Chunk summaries are still collected in full, but the final answer is yielded
+    piece by piece as Bedrock produces it.
+
+    Args:
+        messages (Union[str, list]): The chat messages to be used as context.
+        instructions (str): Additional instructions or question to provide to the model.
+        chunk_size (int): Maximum number of characters per chunk.
+        max_workers (int): Number of chunks sent to the model concurrently.
+
+    Yields:
+        str: Consecutive pieces of the generated response.
+    """
+    if not messages:
+        yield "No messages was found. Consider using other chat."
+        return
 
-    results = response_body.get("results")[0].get("outputText")
-    return results
+    bedrock_runtime = _get_bedrock_runtime()
+    prompt = _reduce_prompt(bedrock_runtime, messages, instructions, chunk_size, max_workers)
+    yield from _invoke_stream(bedrock_runtime, prompt)